@@ -99,4 +99,5 @@ http = dict(
     access_control_allow_origin='*',
     hide_error_details=True,
     manage_cookies=False,
+    use_http2=False,
 )
@@ -606,11 +606,12 @@ class SourceConfiguration(ConfigurationBase):
         headers = self.context.globals.get_value('http.headers', self.conf)
         hide_error_details = self.context.globals.get_value('http.hide_error_details', self.conf)
         manage_cookies = self.context.globals.get_value('http.manage_cookies', self.conf)
+        use_http2 = self.context.globals.get_value('http.use_http2', self.conf)
 
         http_client = HTTPClient(url, username, password, insecure=insecure,
                                  ssl_ca_certs=ssl_ca_certs, timeout=timeout,
                                  headers=headers, hide_error_details=hide_error_details,
-                                 manage_cookies=manage_cookies)
+                                 manage_cookies=manage_cookies, use_http2=use_http2)
         return http_client, url
 
     @memoize
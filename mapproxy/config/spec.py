@@ -87,6 +87,7 @@ http_opts = {
         anything(): str()
     },
     'manage_cookies': bool(),
+    'use_http2': bool(),
 }
 
 mapserver_opts = {
@@ -14,13 +14,37 @@
 # limitations under the License.
 
 
+import functools
+import gzip
 import os
+import shutil
+import socket
+import ssl
+import subprocess
 import sys
+import threading
 import time
 
 import pytest
 
-from mapproxy.client.http import HTTPClient, HTTPClientError
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from mapproxy.client import http as http_module
+from mapproxy.client.http import (
+    HTTPClient,
+    HTTPClientError,
+    retrieve_image,
+    retrieve_images,
+    retrieve_images_parallel,
+)
 from mapproxy.client.tile import TileClient, TileURLTemplate
 from mapproxy.client.wms import WMSClient, WMSInfoClient
 from mapproxy.grid import tile_grid
@@ -57,6 +81,45 @@ class TestHTTPClient(object):
                                               {'status': '200'})]):
             self.client.open(TESTSERVER_URL + '/service', method='HEAD')
 
+    def test_open_image(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tile.png'},
+                                              {'body': b'tile', 'headers': {'content-type': 'image/png'}})]):
+            img = self.client.open_image(TESTSERVER_URL + '/tile.png')
+            assert img.source.read() == b'tile'
+
+    def test_open_image_identity_encoding(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tile.png', 'headers': {'Accept-Encoding': 'identity'}},
+                                              {'body': b'tile', 'headers': {'content-type': 'image/png'}})]):
+            self.client.open_image(TESTSERVER_URL + '/tile.png')
+
+    def test_open_image_no_image(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tile.png'},
+                                              {'body': b'error', 'headers': {'content-type': 'text/plain'}})]):
+            with pytest.raises(HTTPClientError, match='response is not an image'):
+                self.client.open_image(TESTSERVER_URL + '/tile.png')
+
+    def test_open_image_content_length(self):
+        body = b'tile' * 10000
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tile.png'},
+                                              {'body': body, 'headers': {'content-type': 'image/png',
+                                                                         'content-length': str(len(body))}})]):
+            img = self.client.open_image(TESTSERVER_URL + '/tile.png')
+            assert img.source.read() == body
+
+    def test_open_image_gzip_encoded(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tile.png'},
+                                              {'body': gzip.compress(b'tile'),
+                                               'headers': {'content-type': 'image/png',
+                                                           'content-encoding': 'gzip'}})]):
+            img = self.client.open_image(TESTSERVER_URL + '/tile.png')
+            assert img.source.read() == b'tile'
+
+    def test_headers(self):
+        client = HTTPClient(headers={'X-Foo': 'bar', 'User-Agent': 'custom'})
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/', 'headers': {'X-Foo': 'bar', 'User-Agent': 'custom'}},
+                                              {'body': b'nothing'})]):
+            client.open(TESTSERVER_URL + '/')
+
     def test_internal_error_response(self):
         try:
             with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/'},
@@ -355,6 +418,360 @@ class TestTileClient(object):
             assert resp == b'tile'
 
 
+class TestRetrieveImage(object):
+    def test_retrieve_image(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tiles/1.png'},
+                                              {'body': b'tile', 'headers': {'content-type': 'image/png'}})]):
+            img = retrieve_image(TESTSERVER_URL + '/tiles/1.png')
+            assert img.source.read() == b'tile'
+
+    def test_retrieve_image_auth(self):
+        expected_req = [
+            ({'path': '/tiles/1.png', 'require_basic_auth': True},
+             {'body': b'tile', 'headers': {'content-type': 'image/png'}}),
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, expected_req):
+            img = retrieve_image('http://foo:bar@%s:%s/tiles/1.png' % TESTSERVER_ADDRESS)
+            assert img.source.read() == b'tile'
+
+    def test_redirects(self):
+        expected_req = [
+            ({'path': '/tiles/%d.png' % i},
+             {'status': '302', 'body': b'', 'headers': {'Location': TESTSERVER_URL + '/tiles/%d.png' % (i + 1)}})
+            for i in range(5)
+        ] + [({'path': '/tiles/5.png'}, {'body': b'tile', 'headers': {'content-type': 'image/png'}})]
+        with mock_httpd(TESTSERVER_ADDRESS, expected_req):
+            img = retrieve_image(TESTSERVER_URL + '/tiles/0.png')
+            assert img.source.read() == b'tile'
+
+    def test_http_error(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tiles/1.png'}, {'status': '404', 'body': b''})]):
+            with pytest.raises(HTTPClientError) as excinfo:
+                retrieve_image(TESTSERVER_URL + '/tiles/1.png')
+            assert excinfo.value.response_code == 404
+            assert_re(excinfo.value.args[0], r'HTTP Error ".*": 404')
+
+    def test_no_connect(self):
+        with pytest.raises(HTTPClientError, match='No response from URL "http://localhost:53871/"'):
+            retrieve_image('http://localhost:53871/')
+
+    def test_lru_cache(self, monkeypatch):
+        retrieve_content = getattr(http_module._retrieve_image_content, '__wrapped__',
+                                   http_module._retrieve_image_content)
+        monkeypatch.setattr(http_module, '_retrieve_image_content',
+                            functools.lru_cache(maxsize=4)(retrieve_content))
+
+        # only one request, second call is served from the cache
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tiles/1.png'},
+                                              {'body': b'tile', 'headers': {'content-type': 'image/png'}})]):
+            img = retrieve_image(TESTSERVER_URL + '/tiles/1.png')
+            assert img.source.read() == b'tile'
+            img = retrieve_image(TESTSERVER_URL + '/tiles/1.png')
+            assert img.source.read() == b'tile'
+
+    @pytest.mark.parametrize('value,size', [(None, 0), ('', 0), ('128', 128), ('on', 0)])
+    def test_lru_size_from_env(self, monkeypatch, value, size):
+        if value is None:
+            monkeypatch.delenv('MAPPROXY_TILE_LRU', raising=False)
+        else:
+            monkeypatch.setenv('MAPPROXY_TILE_LRU', value)
+        assert http_module._tile_lru_size_from_env() == size
+
+
+class TestURLOpenerCache(object):
+    def test_reuse_session(self):
+        cache = http_module._URLOpenerCache()
+        assert cache(None) is cache(None)
+        assert cache(None) is not cache(None, insecure=True)
+        assert cache(None) is not cache(None, manage_cookies=True)
+
+    def test_max_size(self, monkeypatch):
+        cache = http_module._URLOpenerCache()
+        monkeypatch.setattr(cache, 'max_size', 2)
+        s1 = cache(None)
+        s2 = cache(None, insecure=True)
+        # use s1, s2 is now least recently used
+        assert cache(None) is s1
+        cache(None, manage_cookies=True)
+        assert cache(None) is s1
+        assert cache(None, insecure=True) is not s2
+
+    def test_evicted_session_still_usable(self, monkeypatch):
+        monkeypatch.setattr(http_module.create_url_opener, 'max_size', 1)
+        client = HTTPClient()
+        HTTPClient(insecure=True)
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/'}, {'body': b'ok'})]):
+            assert client.open(TESTSERVER_URL + '/').content == b'ok'
+
+    @pytest.mark.skipif(not httpx, reason="requires httpx")
+    def test_evicted_http2_client_still_usable(self, monkeypatch):
+        monkeypatch.setattr(http_module.create_url_opener, 'max_size', 1)
+        client = HTTPClient(url=TESTSERVER_URL, use_http2=True)
+        HTTPClient(url='http://other.example.org', use_http2=True)
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/'}, {'body': b'ok'})]):
+            assert client.open(TESTSERVER_URL + '/').content == b'ok'
+
+    def test_close_all(self):
+        cache = http_module._URLOpenerCache()
+        s1 = cache(None)
+        cache.pool_manager(None)
+        cache.close_all()
+        assert cache(None) is not s1
+
+    def test_client_context_manager(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/'}, {'body': b'ok'})]):
+            with HTTPClient() as client:
+                resp = client.open(TESTSERVER_URL + '/')
+                assert resp.content == b'ok'
+
+
+@pytest.fixture
+def local_https_server(tmp_path):
+    """
+    Local HTTPS server with a self-signed certificate. Responds with a
+    PNG content type and body ``tile`` to all requests.
+
+    :return: tuple with the server URL and the path of the certificate
+    """
+    if not shutil.which('openssl'):
+        pytest.skip('requires openssl command')
+    cert, key = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+        '-keyout', key, '-out', cert,
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def handle(conn):
+        try:
+            with ctx.wrap_socket(conn, server_side=True) as tls_conn:
+                tls_conn.settimeout(5)
+                data = b''
+                while b'\r\n\r\n' not in data:
+                    chunk = tls_conn.recv(4096)
+                    if not chunk:
+                        return
+                    data += chunk
+                tls_conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: image/png\r\n'
+                                 b'Content-Length: 4\r\nConnection: close\r\n\r\ntile')
+        except (ssl.SSLError, OSError):
+            conn.close()
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn, ), daemon=True).start()
+
+    t = threading.Thread(target=serve, daemon=True)
+    t.start()
+    yield 'https://localhost:%d/' % server.getsockname()[1], cert
+    server.close()
+
+
+@pytest.fixture
+def untrusted_https_url(local_https_server):
+    """
+    URL of a local HTTPS server with a self-signed certificate.
+    """
+    return local_https_server[0]
+
+
+class TestHTTPClientLocalHTTPS(object):
+    def test_ca_certs(self, local_https_server):
+        url, cert = local_https_server
+        client = HTTPClient(url, ssl_ca_certs=cert)
+        assert client.open_image(url).source.read() == b'tile'
+        assert client.open_image(url).source.read() == b'tile'
+        # CA file is loaded once into the shared context, not per connection
+        assert http_module._ssl_context(cert, False).cert_store_stats()['x509_ca'] == 1
+
+    def test_ca_certs_open_fast(self, local_https_server):
+        url, cert = local_https_server
+        client = HTTPClient(url, ssl_ca_certs=cert)
+        assert client.open_fast(url).content == b'tile'
+
+    def test_untrusted(self, local_https_server):
+        url, _ = local_https_server
+        with pytest.raises(HTTPClientError, match='Could not verify connection to URL'):
+            HTTPClient(url).open(url)
+
+    def test_untrusted_open_fast(self, local_https_server):
+        url, _ = local_https_server
+        with pytest.raises(HTTPClientError, match='Could not verify connection to URL'):
+            HTTPClient(url, timeout=5).open_fast(url)
+
+    def test_untrusted_retrieve_image(self, untrusted_https_url):
+        with pytest.raises(HTTPClientError, match='Could not verify connection to URL'):
+            retrieve_image(untrusted_https_url)
+
+    # the filter installed by the client is reset by pytest between tests
+    @pytest.mark.filterwarnings('ignore::urllib3.exceptions.InsecureRequestWarning')
+    def test_insecure(self, local_https_server):
+        url, _ = local_https_server
+        client = HTTPClient(url, insecure=True)
+        assert client.open_image(url).source.read() == b'tile'
+        assert client.open_fast(url).content == b'tile'
+
+
+@pytest.mark.skipif(not httpx, reason="requires httpx")
+class TestHTTP2Client(object):
+    def setup_method(self):
+        self.client = HTTPClient(use_http2=True)
+
+    def test_open(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/service?foo=bar'},
+                                              {'body': b'ok'})]):
+            resp = self.client.open(TESTSERVER_URL + '/service?foo=bar')
+            assert self.client.read_content(TESTSERVER_URL, resp) == b'ok'
+
+    def test_open_image(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tile.png'},
+                                              {'body': b'tile', 'headers': {'content-type': 'image/png'}})]):
+            img = self.client.open_image(TESTSERVER_URL + '/tile.png')
+            assert img.source.read() == b'tile'
+
+    def test_auth(self):
+        client = HTTPClient(username='foo', password='bar', use_http2=True)
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/tile.png', 'require_basic_auth': True},
+                                              {'body': b'tile', 'headers': {'content-type': 'image/png'}})]):
+            img = client.open_image(TESTSERVER_URL + '/tile.png')
+            assert img.source.read() == b'tile'
+
+    def test_manage_cookies_off(self):
+        def assert_no_cookie(req_handler):
+            return 'Cookie' not in req_handler.headers
+
+        test_requests = [
+            (
+                {'path': '/', 'req_assert_function': assert_no_cookie},
+                {'body': b'nothing', 'headers': {'Set-Cookie': "testcookie=42"}}
+            ),
+            (
+                {'path': '/', 'req_assert_function': assert_no_cookie},
+                {'body': b'nothing'}
+            )
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, test_requests):
+            self.client.open(TESTSERVER_URL + '/')
+            self.client.open(TESTSERVER_URL + '/')
+
+    def test_manage_cookies_on(self):
+        client = HTTPClient(manage_cookies=True, use_http2=True)
+
+        def assert_cookie(req_handler):
+            return req_handler.headers.get('Cookie') == 'testcookie=42'
+
+        test_requests = [
+            (
+                {'path': '/'},
+                {'body': b'nothing', 'headers': {'Set-Cookie': "testcookie=42"}}
+            ),
+            (
+                {'path': '/', 'req_assert_function': assert_cookie},
+                {'body': b'nothing'}
+            )
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, test_requests):
+            client.open(TESTSERVER_URL + '/')
+            client.open(TESTSERVER_URL + '/')
+
+    def test_http_error(self):
+        with mock_httpd(TESTSERVER_ADDRESS, [({'path': '/'}, {'status': '500', 'body': b''})]):
+            with pytest.raises(HTTPClientError) as excinfo:
+                self.client.open(TESTSERVER_URL + '/')
+            assert excinfo.value.response_code == 500
+            assert_re(excinfo.value.args[0], r'HTTP Error ".*": 500')
+
+    def test_no_connect(self):
+        with pytest.raises(HTTPClientError, match='No response from URL "http://localhost:53871/"'):
+            self.client.open('http://localhost:53871/')
+
+    def test_untrusted_certificate(self, untrusted_https_url):
+        with pytest.raises(HTTPClientError, match='Could not verify connection to URL'):
+            self.client.open(untrusted_https_url)
+
+
+@pytest.mark.skipif(not aiohttp, reason="requires aiohttp")
+class TestRetrieveImages(object):
+    def test_retrieve_images(self):
+        expected_req = [
+            ({'path': '/tiles/1.png'}, {'body': b'tile1', 'headers': {'content-type': 'image/png'}}),
+            ({'path': '/tiles/2.png'}, {'body': b'tile2', 'headers': {'content-type': 'image/png'}}),
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, expected_req, unordered=True):
+            imgs = retrieve_images([TESTSERVER_URL + '/tiles/2.png', TESTSERVER_URL + '/tiles/1.png'])
+            assert [img.source.read() for img in imgs] == [b'tile2', b'tile1']
+
+    def test_no_image(self):
+        expected_req = [
+            ({'path': '/tiles/1.png'}, {'body': b'error', 'headers': {'content-type': 'text/plain'}}),
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, expected_req):
+            with pytest.raises(HTTPClientError, match='response is not an image'):
+                retrieve_images([TESTSERVER_URL + '/tiles/1.png'])
+
+    def test_http_error(self):
+        expected_req = [
+            ({'path': '/tiles/1.png'}, {'status': '404', 'body': b''}),
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, expected_req):
+            with pytest.raises(HTTPClientError) as excinfo:
+                retrieve_images([TESTSERVER_URL + '/tiles/1.png'])
+            assert excinfo.value.response_code == 404
+
+    def test_timeout(self):
+        # server accepts connections but never responds
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        try:
+            url = 'http://127.0.0.1:%d/tiles/1.png' % server.getsockname()[1]
+            with pytest.raises(HTTPClientError, match='No response from URL ".*": timed out'):
+                retrieve_images([url], timeout=0.5)
+        finally:
+            server.close()
+
+
+class TestRetrieveImagesParallel(object):
+    def test_retrieve_images(self):
+        expected_req = [
+            ({'path': '/tiles/1.png'}, {'body': b'tile1', 'headers': {'content-type': 'image/png'}}),
+            ({'path': '/tiles/2.png'}, {'body': b'tile2', 'headers': {'content-type': 'image/png'}}),
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, expected_req, unordered=True):
+            imgs = retrieve_images_parallel([TESTSERVER_URL + '/tiles/2.png', TESTSERVER_URL + '/tiles/1.png'])
+            assert [img.source.read() for img in imgs] == [b'tile2', b'tile1']
+
+    def test_http_error(self):
+        expected_req = [
+            ({'path': '/tiles/1.png'}, {'status': '404', 'body': b''}),
+        ]
+        with mock_httpd(TESTSERVER_ADDRESS, expected_req):
+            with pytest.raises(HTTPClientError) as excinfo:
+                retrieve_images_parallel([TESTSERVER_URL + '/tiles/1.png'])
+            assert excinfo.value.response_code == 404
+
+    def test_host_semaphores(self, monkeypatch):
+        monkeypatch.setattr(http_module, '_host_semaphores', http_module.OrderedDict())
+        monkeypatch.setattr(http_module, '_host_semaphores_max_size', 2)
+        sem1 = http_module._host_semaphore('host1')
+        sem2 = http_module._host_semaphore('host2')
+        assert http_module._host_semaphore('host1') is sem1
+        http_module._host_semaphore('host3')
+        # host2 was least recently used
+        assert list(http_module._host_semaphores) == ['host1', 'host3']
+        assert http_module._host_semaphore('host2') is not sem2
+
+
 class TestWMSClient(object):
     def test_no_image(self, caplog):
         try: